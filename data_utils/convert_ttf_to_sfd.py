@@ -1,9 +1,178 @@
-import fontforge  # noqa
+import io
 import os
 import sys
+import tarfile
 from tqdm import tqdm
 import multiprocessing as mp
 import argparse
+from fontTools.pens.basePen import BasePen
+from fontTools.ttLib import TTFont
+
+
+class SplineSetPen(BasePen):
+    """Draws a glyph the way its SplineSet is written in sfd files, quadratic curves become cubic"""
+
+    def __init__(self, glyphSet):
+        super().__init__(glyphSet)
+        self.lines = []
+        self.start = None
+
+    def _point(self, pt):
+        return '{:g} {:g}'.format(*pt)
+
+    def _moveTo(self, pt):
+        self.start = pt
+        self.lines.append(f'{self._point(pt)} m 0')
+
+    def _lineTo(self, pt):
+        self.lines.append(f'{self._point(pt)} l 0')
+
+    def _curveToOne(self, pt1, pt2, pt3):
+        self.lines.append(f'{self._point(pt1)} {self._point(pt2)} {self._point(pt3)} c 0')
+
+    def _qCurveToOne(self, pt1, pt2):
+        pt0 = self._getCurrentPoint()
+        ctrl1 = (pt0[0] + 2 / 3 * (pt1[0] - pt0[0]), pt0[1] + 2 / 3 * (pt1[1] - pt0[1]))
+        ctrl2 = (pt2[0] + 2 / 3 * (pt1[0] - pt2[0]), pt2[1] + 2 / 3 * (pt1[1] - pt2[1]))
+        self._curveToOne(ctrl1, ctrl2, pt2)
+
+    def _closePath(self):
+        # closed contours end where they start
+        if self._getCurrentPoint() != self.start:
+            self._lineTo(self.start)
+
+
+SFD_TAIL = (
+    "EndSplineSet\n"
+    "EndChar\n"
+    "EndChars\n"
+    "EndSplineFont\n"
+)
+
+
+def sfd_header(char, fontname):
+    """The part of a one-char sfd font that is shared by all glyphs of a font"""
+    return (
+        "SplineFontDB: 3.0\n"
+        f"FontName: {fontname}\n"
+        "BeginChars: 1 1\n\n"
+        f"StartChar: {char}\n"
+        f"Encoding: {ord(char)} {ord(char)} 0\n"
+    )
+
+
+def sfd_glyph(spline_set, width, vwidth, header):
+    """Writes a single glyph as a one-char sfd font"""
+    return (
+        f"{header}"
+        f"Width: {width}\n"
+        f"VWidth: {vwidth}\n"
+        "Fore\n"
+        "SplineSet\n"
+        f"{spline_set}\n"
+        f"{SFD_TAIL}"
+    )
+
+
+def _is_converted(target_dir, num_chars):
+    """Whether a previous run already wrote the glyphs of every char of this font"""
+    metadata_path = os.path.join(target_dir, 'metadata.tsv')
+    if not os.path.exists(os.path.join(target_dir, 'glyphs.tar')) or not os.path.exists(metadata_path):
+        return False
+    with open(metadata_path, 'r') as metadata_f:
+        return len([line for line in metadata_f.read().split('\n') if line]) >= num_chars
+
+
+def _convert_one(args):
+    """Converts every glyph in charset of a single font to sfd files, archived in one glyphs.tar per font"""
+    font_name, fonts_file_path, split, sfd_path, char_ids, charset_lenw = args
+    font_id = font_name.split('.')[0]
+
+    # metadata.tsv is written last, so a complete one means this font can be skipped on a rerun
+    target_dir = os.path.join(sfd_path, split, "{}".format(font_id))
+    if _is_converted(target_dir, len(char_ids)):
+        return
+
+    font_file_path = os.path.join(fonts_file_path, split, font_name)
+    try:
+        cur_font = TTFont(font_file_path)
+        cmap = cur_font.getBestCmap()
+        glyph_set = cur_font.getGlyphSet()
+        # glyphs without vertical metrics get ascent + descent (the em) as vwidth, like fontforge did
+        hmtx = cur_font['hmtx']
+        vmtx = cur_font['vmtx'] if 'vmtx' in cur_font else None
+        units_per_em = cur_font['head'].unitsPerEm
+    except Exception as e:
+        print('Cannot open ', font_name)
+        print(e)
+        return
+
+    # e.g. symbol fonts that only have a (3, 0) cmap
+    if cmap is None:
+        print('Cannot open ', font_name)
+        print('no unicode cmap in font')
+        cur_font.close()
+        return
+
+    try:
+        _write_glyphs(cmap, glyph_set, hmtx, vmtx, units_per_em, font_name, font_id, target_dir, char_ids, charset_lenw)
+    except Exception as e:
+        print("Found Error:", font_id, font_name)
+        print(e)
+    finally:
+        cur_font.close()
+
+
+def _write_glyphs(cmap, glyph_set, hmtx, vmtx, units_per_em, font_name, font_id, target_dir, char_ids, charset_lenw):
+    """Writes glyphs.tar and metadata.tsv of an opened font"""
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+
+    missing = []
+    metadata = []
+    glyphs_tar = tarfile.open(os.path.join(target_dir, 'glyphs.tar'), 'w')
+    # every glyph is stored in the slot of 'A' of its own sfd, the header is built once per font
+    char = 'A'
+    header = sfd_header(char, "{}_".format(font_id) + font_name)
+    for uni, char_id in char_ids.items():
+        glyph_name = cmap.get(uni)
+        if glyph_name is None:
+            missing.append((uni, char_id))
+            continue
+        try:
+            pen = SplineSetPen(glyph_set)
+            glyph_set[glyph_name].draw(pen)
+            width = hmtx[glyph_name][0]
+            vwidth = vmtx[glyph_name][0] if vmtx is not None else units_per_em
+            sfd = sfd_glyph('\n'.join(pen.lines), width, vwidth, header).encode('utf-8')
+            sfd_info = tarfile.TarInfo(name='{}_{num:0{width}}.sfd'.format(font_id, num=char_id, width=charset_lenw))
+            sfd_info.size = len(sfd)
+            glyphs_tar.addfile(sfd_info, io.BytesIO(sfd))
+
+            # the real codepoint of the glyph, not the one of the 'A' slot it is stored in
+            metadata.append(f"{uni}\t{width}\t{vwidth}\t{char_id:0{charset_lenw}}\t{font_id}")
+        except Exception as e:
+            print("Found Error:", font_id, font_name ,char_id, glyph_name)
+            print(e)
+
+    glyphs_tar.close()
+
+    # one description file per font (uni, width, vwidth, char_id, font_id per glyph)
+    with open(os.path.join(target_dir, 'metadata.tsv'), 'w') as metadata_f:
+        metadata_f.write('\n'.join(metadata))
+
+    for uni, char_id in missing:
+        print("Found Error:", font_id, font_name ,char_id, chr(uni))
+        print("glyph not found in font")
+
+
+def _convert_one_safe(args):
+    """Runs _convert_one, returning the error instead of raising so one bad font doesn't stop the pool"""
+    try:
+        _convert_one(args)
+    except Exception as e:
+        return args[0], e
+    return args[0], None
 
 
 def convert_mp(opts):
@@ -22,71 +191,20 @@ def convert_mp(opts):
         ttf_fnames = files
         print(ttf_fnames)
 
-    font_num = len(ttf_fnames)
-    process_num = mp.cpu_count() - 1
-    font_num_per_process = font_num // process_num + 1
-
-    def process(process_id, font_num_p_process):
-        for i in tqdm(range(process_id * font_num_p_process, (process_id + 1) * font_num_p_process)):
-            if i >= font_num:
-                break
-
-            font_id = ttf_fnames[i].split('.')[0]
-            split = opts.split
-            font_name = ttf_fnames[i]
-
-            font_file_path = os.path.join(fonts_file_path, split, font_name)
-            try:
-                cur_font = fontforge.open(font_file_path)
-            except Exception as e:
-                print('Cannot open ', font_name)
-                print(e)
-                continue
-
-            target_dir = os.path.join(sfd_path, split, "{}".format(font_id))
-            if not os.path.exists(target_dir):
-                os.makedirs(target_dir)
-
-            for char_id, char in enumerate(charset):
-              try:
-                char_description = open(os.path.join(target_dir, '{}_{num:0{width}}.txt'.format(font_id, num=char_id, width=charset_lenw)), 'w')
-                if char in charset_th:
-                    char = 'uni' + char.encode("unicode_escape")[2:].decode("utf-8")
-
-                cur_font.selection.select(char)
-                cur_font.copy()
-
-                new_font_for_char = fontforge.font()
-                # new_font_for_char.ascent = 750
-                # new_font_for_char.descent = 250
-                # new_font_for_char.em = new_font_for_char.ascent + new_font_for_char.descent
-                char = 'A'
-
-                new_font_for_char.selection.select(char)
-                new_font_for_char.paste()
-                new_font_for_char.fontname = "{}_".format(font_id) + font_name
-
-                new_font_for_char.save(os.path.join(target_dir, '{}_{num:0{width}}.sfd'.format(font_id, num=char_id, width=charset_lenw)))
-
-                char_description.write(str(ord(char)) + '\n')
-                char_description.write(str(new_font_for_char[char].width) + '\n')
-                char_description.write(str(new_font_for_char[char].vwidth) + '\n')
-                char_description.write('{num:0{width}}'.format(num=char_id, width=charset_lenw) + '\n')
-                char_description.write('{}'.format(font_id))
-                # print('{}_{num:0{width}}.sfd'.format(font_id, num=char_id, width=charset_lenw))
-                char_description.close()
-              except Exception as e:
-                print("Found Error:", font_id, font_name ,char_id, char)
-                print(e)
-
-            cur_font.close()
-
-    processes = [mp.Process(target=process, args=(pid, font_num_per_process)) for pid in range(process_num)]
-
-    for p in processes:
-        p.start()
-    for p in processes:
-        p.join()
+    # codepoint -> char_id, computed once and shared by all fonts
+    char_ids = {ord(char): char_id for char_id, char in enumerate(charset)}
+
+    process_num = max(1, mp.cpu_count() - 1)
+    args = [(font_name, fonts_file_path, opts.split, sfd_path, char_ids, charset_lenw) for font_name in ttf_fnames]
+
+    # fonts are handed out one chunk at a time so big fonts don't leave the other workers idle,
+    # fork shares the already imported modules with the workers on linux
+    ctx = mp.get_context('fork') if sys.platform.startswith('linux') else mp.get_context()
+    with ctx.Pool(process_num) as pool:
+        for font_name, error in tqdm(pool.imap_unordered(_convert_one_safe, args, chunksize=4), total=len(args)):
+            if error is not None:
+                print("Found Error:", font_name)
+                print(error)
 
 
 def main():
@@ -2,6 +2,7 @@ import argparse
 import multiprocessing as mp
 import os
 import pickle
+import tarfile
 import numpy as np
 from data_utils import svg_utils
 from tqdm import tqdm
@@ -47,25 +48,32 @@ def create_db(opts, output_path, log_path):
             if not os.path.exists(os.path.join(cur_font_sfd_dir, 'imgs_' + str(opts.img_size) + '.npy')):
                 continue
 
+            # uni, width, vwidth, char_id, font_id of every converted glyph
+            with open(os.path.join(cur_font_sfd_dir, 'metadata.tsv'), 'r') as metadata_f:
+                metadata = {int(fields[3]): fields for fields in (line.split('\t') for line in metadata_f.read().split('\n')) if len(fields) == 5}
+            # the sfd of every glyph is a member of the font's glyphs.tar, indexed by name
+            glyphs_tar = tarfile.open(os.path.join(cur_font_sfd_dir, 'glyphs.tar'), 'r')
+            sfd_members = {member.name: member for member in glyphs_tar.getmembers()}
+
             # a whole font as an entry
             for char_id in range(num_chars):
                 # print('char_id :',char_id)
-                if not os.path.exists(os.path.join(cur_font_sfd_dir, '{}_{num:0{width}}.sfd'.format(font_id, num=char_id, width=num_chars_w))):
+                sfd_name = '{}_{num:0{width}}.sfd'.format(font_id, num=char_id, width=num_chars_w)
+                if sfd_name not in sfd_members or char_id not in metadata:
                     break
 
-                char_desp_f = open(os.path.join(cur_font_sfd_dir, '{}_{num:0{width}}.txt'.format(font_id, num=char_id, width=num_chars_w)), 'r')
-                char_desp = char_desp_f.readlines()
-                sfd_f = open(os.path.join(cur_font_sfd_dir, '{}_{num:0{width}}.sfd'.format(font_id, num=char_id, width=num_chars_w)), 'r')
-                sfd = sfd_f.read()
+                char_desp = metadata[char_id]
+                sfd = glyphs_tar.extractfile(sfd_members[sfd_name]).read().decode('utf-8')
 
-                uni = int(char_desp[0].strip())
                 width = int(char_desp[1].strip())
                 vwidth = int(char_desp[2].strip())
                 char_idx = char_desp[3].strip()
                 font_idx = char_desp[4].strip()
 
                 cur_glyph = {}
-                cur_glyph['uni'] = uni
+                # metadata has the real codepoint, but every sfd stores its glyph in the slot of 'A',
+                # which is what is_valid_glyph and the class mapping expect
+                cur_glyph['uni'] = ord('A')
                 cur_glyph['width'] = width
                 cur_glyph['vwidth'] = vwidth
                 cur_glyph['sfd'] = sfd
@@ -76,8 +84,6 @@ def create_db(opts, output_path, log_path):
                     msg = f"font {font_idx}, char {char_idx} is not a valid glyph\n"
                     invalid_path.glypts([font_idx, int(char_idx), charset[int(char_idx)]])
                     cur_process_log_file.write(msg)
-                    char_desp_f.close()
-                    sfd_f.close()
                     # use the font whose all glyphs are valid
                     break
                 pathunibfp = svg_utils.convert_to_path(cur_glyph)
@@ -86,15 +92,12 @@ def create_db(opts, output_path, log_path):
                     msg = f"font {font_idx}, char {char_idx}'s sfd is not a valid path\n"
                     invalid_path.append([font_idx, int(char_idx), charset[int(char_idx)]])
                     cur_process_log_file.write(msg)
-                    char_desp_f.close()
-                    sfd_f.close()
                     break
                 valid_chars.append([font_idx, int(char_idx), charset[int(char_idx)]])
                 example = svg_utils.create_example(pathunibfp)
 
                 cur_font_glyphs.append(example)
-                char_desp_f.close()
-                sfd_f.close()
+            glyphs_tar.close()
 
             if len(cur_font_glyphs) == num_chars:
                 # use the font whose all glyphs are valid
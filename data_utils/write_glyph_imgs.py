@@ -57,18 +57,19 @@ def write_glyph_imgs_mp(opts):
 
             flag_success = True
 
+            # read the meta file, one line per converted glyph
+            try:
+                metadata_lines = open(os.path.join(sfd_path, opts.split, fontname, 'metadata.tsv'), 'r').read().split('\n')
+            except:
+                print('cannot read metadata file')
+                metadata_lines = []
+            metadata = {int(fields[3]): fields for fields in (line.split('\t') for line in metadata_lines) if len(fields) == 5}
+
             for charid in range(len(charset)):
-                # read the meta file
-                txt_fpath = os.path.join(sfd_path, opts.split, fontname, fontname + '_' + '{num:0{width}}'.format(num=charid, width=charset_lenw) + '.txt')
-                try:
-                    txt_lines = open(txt_fpath,'r').read().split('\n')
-                except:
-                    print('cannot read text file')
-                    flag_success = False
-                    break
-                if len(txt_lines) < 5:
+                if charid not in metadata:
                     flag_success = False
-                    break # should be empty file
+                    break # glyph was not converted
+                txt_lines = metadata[charid]
                 # the offsets are calculated according to the rules in data_utils/svg_utils.py
                 vbox_w = float(txt_lines[1])
                 vbox_h = float(txt_lines[2])
@@ -45,13 +45,46 @@ class SVGDataset(data.Dataset):
         return len(self.font_paths)
 
 
-def get_loader(root_path, img_size, lang, char_num, max_seq_len, dim_seq, batch_size, mode='train'):
+def get_loader(root_path, img_size, lang, char_num, max_seq_len, dim_seq, batch_size, mode='train', distributed=False):
     SetRange = T.Lambda(lambda X: 1. - X )  # convert [0, 1] -> [0, 1]
     transform = T.Compose([SetRange])
     dataset = SVGDataset(root_path, img_size, lang, char_num, max_seq_len, dim_seq, transform, mode)
-    dataloader = data.DataLoader(dataset, batch_size, shuffle=(mode == 'train'), num_workers=batch_size)
+    # each process of a distributed run only loads its own shard of the fonts
+    sampler = data.distributed.DistributedSampler(dataset, shuffle=(mode == 'train')) if distributed else None
+    dataloader = data.DataLoader(dataset, batch_size, shuffle=(mode == 'train' and sampler is None), sampler=sampler, num_workers=batch_size,
+                                 pin_memory=True, persistent_workers=True, prefetch_factor=4)
     return dataloader
 
+
+class CUDAPrefetcher:
+    """Copies the next batch to the gpu on a side stream while the current batch is computed"""
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        next_batch = self._preload(loader_iter)
+        while next_batch is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            batch = next_batch
+            for value in batch.values():
+                value.record_stream(torch.cuda.current_stream())
+            next_batch = self._preload(loader_iter)
+            yield batch
+
+    def _preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return {key: value.to('cuda', non_blocking=True) for key, value in batch.items()}
+
 if __name__ == '__main__':
     root_path = 'data/new_data'
     max_seq_len = 51
@@ -150,11 +150,15 @@ class ModelMain(nn.Module):
         # choose reference classes and target classes
 
 
+        # classes are sampled on the gpu directly, without a host to device copy,
+        # the step is still not cuda graph capturable: Transformer.loss builds its masks from host tensors,
+        # the last batch has a different shape and val takes a different path
+        device = input_image.device
         if mode == 'train':
-            ref_cls = torch.randint(0, self.opts.char_num, (input_image.size(0), self.opts.ref_nshot)).cuda()
+            ref_cls = torch.randint(0, self.opts.char_num, (input_image.size(0), self.opts.ref_nshot), device=device)
             if opts.ref_nshot == 52: # For ENG to TH
-                ref_cls_upper = torch.randint(0, 52, (input_image.size(0), self.opts.ref_nshot // 2)).cuda()
-                ref_cls_lower = torch.randint(26, 52, (input_image.size(0), self.opts.ref_nshot // 2)).cuda()
+                ref_cls_upper = torch.randint(0, 52, (input_image.size(0), self.opts.ref_nshot // 2), device=device)
+                ref_cls_lower = torch.randint(26, 52, (input_image.size(0), self.opts.ref_nshot // 2), device=device)
                 ref_cls = torch.cat((ref_cls_upper, ref_cls_lower), -1)
         elif mode == 'val':
             ref_cls = torch.arange(0, self.opts.ref_nshot, 1).cuda().unsqueeze(0).expand(input_image.size(0), -1)
@@ -167,9 +171,9 @@ class ModelMain(nn.Module):
         
         
         if mode in {'train', 'val'}:
-            trg_cls = torch.randint(0, self.opts.char_num, (input_image.size(0), 1)).cuda()
+            trg_cls = torch.randint(0, self.opts.char_num, (input_image.size(0), 1), device=device)
             if opts.ref_nshot == 52:
-                trg_cls = torch.randint(52, opts.char_num, (input_image.size(0), 1)).cuda()
+                trg_cls = torch.randint(52, opts.char_num, (input_image.size(0), 1), device=device)
         else:
             trg_cls = torch.arange(0, self.opts.char_num).cuda()
             if opts.ref_nshot == 52:
@@ -202,10 +206,8 @@ class ModelMain(nn.Module):
         ref_seq_cat = ref_seq_cat.transpose(0,1)
         ref_seqlen = util_funcs.select_seqlens(input_seqlen, ref_cls, self.opts)
         ref_seqlen_cat = ref_seqlen.view(ref_seqlen.size(0) * ref_seqlen.size(1), ref_seqlen.size(2))
-        ref_pad_mask = torch.zeros(ref_seqlen_cat.size(0), self.opts.max_seq_len) # value = 1 means pos to be masked
-        for i in range(ref_seqlen_cat.size(0)):
-            ref_pad_mask[i,:ref_seqlen_cat[i]] = 1
-        ref_pad_mask = ref_pad_mask.cuda().float().unsqueeze(1)
+        # value = 1 means pos to be masked, built on the gpu instead of one synced slice per ref glyph
+        ref_pad_mask = util_funcs.sequence_mask(ref_seqlen_cat.view(-1), self.opts.max_seq_len).float().unsqueeze(1)
         trg_seqlen = util_funcs.select_seqlens(input_seqlen, trg_cls, self.opts)
         trg_seqlen = trg_seqlen.squeeze()
 
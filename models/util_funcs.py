@@ -1,5 +1,7 @@
+import os
 import torch
 import torch.nn.functional as F
+import safetensors.torch
 import cairosvg
 from data_utils.common_utils import trans2_white_bg
 from PIL import Image
@@ -74,6 +76,24 @@ def sequence_mask(lengths, max_len=None):
     .unsqueeze(0).expand(batch_size,max_len)
     .lt(lengths.unsqueeze(1)))
 
+def load_ckpt(path_ckpt, device='cpu', model_only=False):
+    """Loads a checkpoint written as <path_ckpt>.model.safetensors + <path_ckpt>.opt.pt, or a single torch.save file,
+    path_ckpt can also be the .model.safetensors file itself"""
+    if path_ckpt.endswith('.model.safetensors'):
+        path_ckpt = path_ckpt[:-len('.model.safetensors')]
+    path_model, path_opt = path_ckpt + '.model.safetensors', path_ckpt + '.opt.pt'
+    if not os.path.isfile(path_model):
+        if not os.path.isfile(path_ckpt):
+            raise FileNotFoundError(f"Checkpoint file not found at {path_ckpt}")
+        return torch.load(path_ckpt, map_location=device)
+    checkpoint = {}
+    if not model_only:
+        if not os.path.isfile(path_opt):
+            raise FileNotFoundError(f"Optimizer state of checkpoint {path_ckpt} not found at {path_opt}")
+        checkpoint = torch.load(path_opt, map_location=device)
+    checkpoint['model'] = safetensors.torch.load_file(path_model, device=str(device))
+    return checkpoint
+
 def svg2img(path_svg, path_img, img_size):
     cairosvg.svg2png(url=path_svg, write_to=path_img, output_width=img_size, output_height=img_size)
     img_arr = trans2_white_bg(path_img)
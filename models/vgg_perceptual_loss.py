@@ -56,7 +56,10 @@ class VGGPerceptualLoss(torch.nn.Module):
         input_img = (input_img - self.mean) / self.std
         target_img = (target_img - self.mean) / self.std
 
-        x_vgg, y_vgg = self.vgg(input_img), self.vgg(target_img)
+        # the target only serves as a reference, its features never need a graph for backward
+        x_vgg = self.vgg(input_img)
+        with torch.no_grad():
+            y_vgg = self.vgg(target_img)
 
         loss = {}
         loss['pt_c_loss'] = self.weights[0] * self.criterion(x_vgg[0], y_vgg[0])+\
@@ -9,8 +9,8 @@ def get_parser_main_model():
     parser.add_argument('--char_num', type=int, default=44, help='number of glyphs, original is 44 (Thai)')
     parser.add_argument('--seed', type=int, default=3712)
     parser.add_argument('--ref_nshot', type=int, default=8, help='reference number')    
-    parser.add_argument('--batch_size', type=int, default=64, help='batch size')
-    parser.add_argument('--batch_size_val', type=int, default=8, help='batch size when do validation')
+    parser.add_argument('--batch_size', type=int, default=64, help='batch size, split across the gpus with --multi_gpu')
+    parser.add_argument('--batch_size_val', type=int, default=8, help='batch size when do validation, split across the gpus with --multi_gpu')
     parser.add_argument('--img_size', type=int, default=64, help='image size')
     parser.add_argument('--max_seq_len', type=int, default=121, help='maximum length of sequence')
     parser.add_argument('--dim_seq', type=int, default=12, help='the dim of each stroke in a sequence, 4 + 8, 4 is cmd, and 8 is args')
@@ -31,6 +31,9 @@ def get_parser_main_model():
 
     parser.add_argument('--mode', type=str, default='test', choices=['train', 'val', 'test'])
     parser.add_argument('--multi_gpu', type=bool, default=False)
+    parser.add_argument('--compile', type=bool, default=False, help='whether compile the model with torch.compile (needs torch >= 2.0)')
+    parser.add_argument('--deterministic', type=bool, default=False, help='whether use deterministic cudnn algorithms instead of the autotuned ones')
+    parser.add_argument('--amp', type=str, default='bf16', choices=['fp32', 'bf16', 'fp16'], help='precision of the forward pass and losses when training')
     parser.add_argument('--name_exp', type=str, default='dvf')
 
     # continue training'
@@ -2,6 +2,7 @@ import os
 import torch
 from dataloader import get_loader
 from models.model_main import ModelMain
+from models.util_funcs import load_ckpt
 from options import get_parser_main_model
 import warnings
 warnings.filterwarnings("ignore")
@@ -16,11 +17,8 @@ def test_main_model(opts):
     model_main = ModelMain(opts).to(device)
     path_ckpt = os.path.join(opts.model_path)
     
-    # Check if checkpoint path is correct and the file exists
-    if not os.path.isfile(path_ckpt):
-        raise FileNotFoundError(f"Checkpoint file not found at {path_ckpt}")
-
-    checkpoint = torch.load(path_ckpt, map_location=device)
+    # Check if checkpoint path is correct and the file exists, either as a .ckpt or as its .model.safetensors
+    checkpoint = load_ckpt(path_ckpt, device=device, model_only=True)
     model_main.load_state_dict(checkpoint['model'])
 
     with torch.no_grad():
@@ -8,7 +8,7 @@ from models.model_main import ModelMain
 from models.transformers import denumericalize
 from options import get_parser_main_model
 from data_utils.svg_utils import render
-from models.util_funcs import svg2img, cal_iou
+from models.util_funcs import svg2img, cal_iou, load_ckpt
 from tqdm import tqdm
 from PIL import Image
 
@@ -28,7 +28,7 @@ def test_main_model(opts):
         device = torch.device("cuda")
     else:
         device = torch.device("cpu")
-    model_main.load_state_dict(torch.load(path_ckpt)['model'])
+    model_main.load_state_dict(load_ckpt(path_ckpt, device=device, model_only=True)['model'])
     model_main.to(device)
     model_main.eval()
     with torch.no_grad():
@@ -1,40 +1,85 @@
+import io
 import os
 import random
 import numpy as np
 import shutil
 import torch
+import safetensors.torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.optim import Adam, AdamW
 from torchvision.utils import save_image
 import wandb
-from dataloader import get_loader
+from dataloader import get_loader, CUDAPrefetcher
 from models import util_funcs
 from models.model_main import ModelMain
 from options import get_parser_main_model
 from data_utils.svg_utils import render
 from time import time
+from concurrent.futures import ThreadPoolExecutor
 
-def setup_seed(seed):
+CKPT_CHUNK_SIZE = 64 * 1024 * 1024
+
+def setup_seed(seed, deterministic=False):
     torch.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
     np.random.seed(seed)
     random.seed(seed)
-    torch.backends.cudnn.deterministic = True
+    # input shapes are fixed, so the autotuner only picks the conv algorithms once
+    torch.backends.cudnn.deterministic = deterministic
+    torch.backends.cudnn.benchmark = not deterministic
+
+def _flush_ckpt(files, run=None):
+    """Writes the already serialized checkpoint files to disk in large chunks, then uploads them to wandb"""
+    for buf, path in files:
+        # slicing a memoryview doesn't copy the chunk
+        buf = memoryview(buf)
+        tmp_path = path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            offset = 0
+            while offset < len(buf):
+                offset += os.write(fd, buf[offset:offset + CKPT_CHUNK_SIZE])
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+        print(f"Saved {path}")
+    if run is not None:
+        artifact = wandb.Artifact('model_main_checkpoints', type='model')
+        for _, path in files:
+            artifact.add_file(path)
+        run.log_artifact(artifact)
 
 def train_main_model(opts):
-    setup_seed(opts.seed)
+    # multi gpu runs are launched with torchrun, one process per gpu
+    if opts.multi_gpu:
+        dist.init_process_group('nccl')
+        local_rank = int(os.environ['LOCAL_RANK'])
+        torch.cuda.set_device(local_rank)
+    is_main = not opts.multi_gpu or dist.get_rank() == 0
+    setup_seed(opts.seed, opts.deterministic)
     dir_exp = os.path.join(f"{opts.exp_path}", "experiments", opts.name_exp)
     dir_sample = os.path.join(dir_exp, "samples")
     dir_ckpt = os.path.join(dir_exp, "checkpoints")
     dir_log = os.path.join(dir_exp, "logs")
-    logfile_train = open(os.path.join(dir_log, "train_loss_log.txt"), 'w')
-    logfile_val = open(os.path.join(dir_log, "val_loss_log.txt"), 'w')
+    # only the main process writes the logs, other ranks opening them with 'w' would truncate them
+    if is_main:
+        logfile_train = open(os.path.join(dir_log, "train_loss_log.txt"), 'w')
+        logfile_val = open(os.path.join(dir_log, "val_loss_log.txt"), 'w')
 
-    train_loader = get_loader(opts.data_root, opts.img_size, opts.language, opts.char_num, opts.max_seq_len, opts.dim_seq, opts.batch_size, opts.mode)
-    val_loader = get_loader(opts.data_root, opts.img_size, opts.language, opts.char_num, opts.max_seq_len, opts.dim_seq, opts.batch_size_val, 'val')
+    # the batch sizes are global and split across the gpus, as they were with DataParallel
+    world_size = dist.get_world_size() if opts.multi_gpu else 1
+    batch_size, batch_size_val = max(1, opts.batch_size // world_size), max(1, opts.batch_size_val // world_size)
+    train_loader = get_loader(opts.data_root, opts.img_size, opts.language, opts.char_num, opts.max_seq_len, opts.dim_seq, batch_size, opts.mode, distributed=opts.multi_gpu)
+    val_loader = get_loader(opts.data_root, opts.img_size, opts.language, opts.char_num, opts.max_seq_len, opts.dim_seq, batch_size_val, 'val', distributed=opts.multi_gpu)
+    # looked up once instead of on every iteration
+    n_train, n_val = len(train_loader), len(val_loader)
+    w_l1, w_pt_c, kl_beta = opts.loss_w_l1, opts.loss_w_pt_c, opts.kl_beta
+    w_cmd, w_args, w_smt, w_aux = opts.loss_w_cmd, opts.loss_w_args, opts.loss_w_smt, opts.loss_w_aux
 
-    run = wandb.init(project=opts.wandb_project_name, config=opts) # initialize wandb project
+    run = wandb.init(project=opts.wandb_project_name, config=opts, mode=None if is_main else 'disabled') # initialize wandb project
 
     model_main = ModelMain(opts)
     model_main.cuda()
@@ -45,138 +90,172 @@ def train_main_model(opts):
 
     optimizer = AdamW(parameters_all, lr=opts.lr, betas=(opts.beta1, opts.beta2), eps=opts.eps, weight_decay=opts.weight_decay)
 
+    # mixed precision, fp16 needs the loss scaled to not underflow the gradients
+    amp = opts.amp
+    if amp == 'bf16' and not torch.cuda.is_bf16_supported():
+        print("bf16 is not supported on this gpu, falling back to fp16")
+        amp = 'fp16'
+    use_amp = amp != 'fp32'
+    amp_dtype = torch.float16 if amp == 'fp16' else torch.bfloat16
+    scaler = torch.cuda.amp.GradScaler(enabled=(amp == 'fp16'))
+
+    # checkpoints are saved from and loaded into the plain module, not the compiled/parallel wrappers
+    model_base = model_main
+    # no cuda graphs ('reduce-overhead'), the step builds masks from host tensors and the last batch differs in shape
+    if opts.compile and hasattr(torch, 'compile'):
+        model_main = torch.compile(model_main, fullgraph=False)
+
     if torch.cuda.is_available() and opts.multi_gpu:
-        model_main = torch.nn.DataParallel(model_main)
+        # some submodules of the transformers are never used in forward
+        model_main = DDP(model_main, device_ids=[local_rank], find_unused_parameters=True)
     
     # For Continue Training
     if opts.continue_training:
-        checkpoint = torch.load(opts.continue_ckpt)
-        model_main.load_state_dict(checkpoint['model'])
-        optimizer.load_state_dict(checkpoint['opt'])    
+        checkpoint = util_funcs.load_ckpt(opts.continue_ckpt, device='cuda')
+        model_base.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['opt'])
+        # a disabled scaler (bf16/fp32 runs) saves an empty state, which an enabled one refuses to load
+        if checkpoint.get('scaler'):
+            scaler.load_state_dict(checkpoint['scaler'])
     
     scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer, gamma=0.997)
-    
+    # checkpoints are written to disk by a background thread so training is not blocked
+    ckpt_executor = ThreadPoolExecutor(max_workers=1)
+    ckpt_future = None
 
-    for epoch in range(opts.init_epoch, opts.n_epochs):
-        t0 = time()
-        for idx, data in enumerate(train_loader):
-            for key in data: data[key] = data[key].cuda()
-            ret_dict, loss_dict = model_main(data)
+    try:
+        for epoch in range(opts.init_epoch, opts.n_epochs):
+            t0 = time()
+            if opts.multi_gpu:
+                train_loader.sampler.set_epoch(epoch)
+            for idx, data in enumerate(CUDAPrefetcher(train_loader)):
+                with torch.autocast(device_type='cuda', dtype=amp_dtype, enabled=use_amp):
+                    ret_dict, loss_dict = model_main(data)
 
-            loss = opts.loss_w_l1 * loss_dict['img']['l1'] + opts.loss_w_pt_c * loss_dict['img']['vggpt'] + opts.kl_beta * loss_dict['kl'] \
-                    + loss_dict['svg']['total'] + loss_dict['svg_para']['total']
+                    loss = w_l1 * loss_dict['img']['l1'] + w_pt_c * loss_dict['img']['vggpt'] + kl_beta * loss_dict['kl'] \
+                            + loss_dict['svg']['total'] + loss_dict['svg_para']['total']
             
-            # perform optimization
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-            batches_done = epoch * len(train_loader) + idx + 1 
-            message = (
-                f"Time: {'{} seconds'.format(time() - t0)}, "
-                f"Epoch: {epoch}/{opts.n_epochs}, Batch: {idx}/{len(train_loader)}, "
-                f"Loss: {loss.item():.6f}, "
-                f"img_l1_loss: {opts.loss_w_l1 * loss_dict['img']['l1'].item():.6f}, "
-                f"img_pt_c_loss: {opts.loss_w_pt_c * loss_dict['img']['vggpt']:.6f}, "
-                f"svg_total_loss: {loss_dict['svg']['total'].item():.6f}, "
-                f"svg_cmd_loss: {opts.loss_w_cmd * loss_dict['svg']['cmd'].item():.6f}, "
-                f"svg_args_loss: {opts.loss_w_args * loss_dict['svg']['args'].item():.6f}, "
-                f"svg_smooth_loss: {opts.loss_w_smt * loss_dict['svg']['smt'].item():.6f}, "
-                f"svg_aux_loss: {opts.loss_w_aux * loss_dict['svg']['aux'].item():.6f}, "
-                f"lr: {optimizer.param_groups[0]['lr']:.6f}, "
-                f"Step: {batches_done}"
-            )
-            if batches_done % opts.freq_log == 0:
-                logfile_train.write(message + '\n')
-                print(message)
-
-                if opts.wandb:
-                    # print("Running With Wandb")
-                    # Define the items for image and SVG losses
+                # perform optimization
+                optimizer.zero_grad(set_to_none=True)
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
+                batches_done = epoch * n_train + idx + 1 
+                if batches_done % opts.freq_log == 0 and is_main:
+                    # fetch every logged loss to the host in one transfer
                     loss_img_items = ['l1', 'vggpt']
                     loss_svg_items = ['total', 'cmd', 'args', 'aux', 'smt']
+                    loss_items = {'total': loss, 'kl': loss_dict['kl'], **{('img', item): loss_dict['img'][item] for item in loss_img_items},
+                                  **{(cat, item): loss_dict[cat][item] for cat in ['svg', 'svg_para'] for item in loss_svg_items}}
+                    loss_log = dict(zip(loss_items, torch.stack([value.detach().float() for value in loss_items.values()]).cpu().tolist()))
 
-                    # Log image loss items
-                    for item in loss_img_items:
-                        wandb.log({f'Loss/img_{item}': loss_dict['img'][item].item()}, step=batches_done)
-
-                    # Log SVG loss items
-                    for item in loss_svg_items:
-                        wandb.log({f'Loss/svg_{item}': loss_dict['svg'][item].item()}, step=batches_done)
-                        wandb.log({f'Loss/svg_para_{item}': loss_dict['svg_para'][item].item()}, step=batches_done)
-
-                    # Log KL loss
-                    wandb.log({'Loss/img_kl_loss': opts.kl_beta * loss_dict['kl'].item()}, step=batches_done)
+                    message = (
+                        f"Time: {'{} seconds'.format(time() - t0)}, "
+                        f"Epoch: {epoch}/{opts.n_epochs}, Batch: {idx}/{n_train}, "
+                        f"Loss: {loss_log['total']:.6f}, "
+                        f"img_l1_loss: {w_l1 * loss_log['img', 'l1']:.6f}, "
+                        f"img_pt_c_loss: {w_pt_c * loss_log['img', 'vggpt']:.6f}, "
+                        f"svg_total_loss: {loss_log['svg', 'total']:.6f}, "
+                        f"svg_cmd_loss: {w_cmd * loss_log['svg', 'cmd']:.6f}, "
+                        f"svg_args_loss: {w_args * loss_log['svg', 'args']:.6f}, "
+                        f"svg_smooth_loss: {w_smt * loss_log['svg', 'smt']:.6f}, "
+                        f"svg_aux_loss: {w_aux * loss_log['svg', 'aux']:.6f}, "
+                        f"lr: {optimizer.param_groups[0]['lr']:.6f}, "
+                        f"Step: {batches_done}"
+                    )
+                    logfile_train.write(message + '\n')
+                    print(message)
 
-                    wandb.log({
-                        'Images/trg_img': wandb.Image(ret_dict['img']['trg'][0], caption="Target"),
-                        'Images/img_output': wandb.Image(ret_dict['img']['out'][0], caption="Output")
-                    }, step=batches_done)
+                    if opts.wandb:
+                        # a single log call per step for all losses and images
+                        wandb.log({
+                            **{f'Loss/img_{item}': loss_log['img', item] for item in loss_img_items},
+                            **{f'Loss/svg_{item}': loss_log['svg', item] for item in loss_svg_items},
+                            **{f'Loss/svg_para_{item}': loss_log['svg_para', item] for item in loss_svg_items},
+                            'Loss/img_kl_loss': kl_beta * loss_log['kl'],
+                            'Images/trg_img': wandb.Image(ret_dict['img']['trg'][0].float(), caption="Target"),
+                            'Images/img_output': wandb.Image(ret_dict['img']['out'][0].float(), caption="Output")
+                        }, step=batches_done)
                     
-            if opts.freq_sample > 0 and batches_done % opts.freq_sample == 0:
+                if opts.freq_sample > 0 and batches_done % opts.freq_sample == 0 and is_main:
                 
-                img_sample = torch.cat((ret_dict['img']['trg'].data, ret_dict['img']['out'].data), -2)
-                save_file = os.path.join(dir_sample, f"train_epoch_{epoch}_batch_{batches_done}.png")
-                save_image(img_sample, save_file, nrow=8, normalize=True)    
+                    img_sample = torch.cat((ret_dict['img']['trg'].data, ret_dict['img']['out'].data.float()), -2)
+                    save_file = os.path.join(dir_sample, f"train_epoch_{epoch}_batch_{batches_done}.png")
+                    save_image(img_sample, save_file, nrow=8, normalize=True)    
                 
-            if opts.freq_val > 0 and batches_done % opts.freq_val == 0:
+                if opts.freq_val > 0 and batches_done % opts.freq_val == 0:
 
-                with torch.no_grad():
-                    model_main.eval()
-                    loss_val = {'img':{'l1':0.0, 'vggpt':0.0}, 'svg':{'total':0.0, 'cmd':0.0, 'args':0.0, 'aux':0.0},
-                                'svg_para':{'total':0.0, 'cmd':0.0, 'args':0.0, 'aux':0.0}}
+                    with torch.no_grad():
+                        model_main.eval()
+                        loss_val = {'img':{'l1':0.0, 'vggpt':0.0}, 'svg':{'total':0.0, 'cmd':0.0, 'args':0.0, 'aux':0.0},
+                                    'svg_para':{'total':0.0, 'cmd':0.0, 'args':0.0, 'aux':0.0}}
+                        # all val losses are summed in one gpu tensor, in this fixed order
+                        loss_val_keys = [(loss_cat, key) for loss_cat in ['img', 'svg'] for key in loss_val[loss_cat]]
+                        loss_val_acc = torch.zeros(len(loss_val_keys), device='cuda')
                     
-                    for val_idx, val_data in enumerate(val_loader):
-                        for key in val_data: val_data[key] = val_data[key].cuda()
-                        ret_dict_val, loss_dict_val = model_main(val_data, mode='val')
-                        for loss_cat in ['img', 'svg']:
-                            for key, _ in loss_val[loss_cat].items():
-                                loss_val[loss_cat][key] += loss_dict_val[loss_cat][key]
+                        for val_idx, val_data in enumerate(val_loader):
+                            val_data = {key: value.to('cuda', non_blocking=True) for key, value in val_data.items()}
+                            with torch.autocast(device_type='cuda', dtype=amp_dtype, enabled=use_amp):
+                                ret_dict_val, loss_dict_val = model_main(val_data, mode='val')
+                            loss_val_acc += torch.stack([loss_dict_val[loss_cat][key].detach().float() for loss_cat, key in loss_val_keys])
 
-                    for loss_cat in ['img', 'svg']:
-                        for key, _ in loss_val[loss_cat].items():
-                            loss_val[loss_cat][key] /= len(val_loader) 
+                        # every rank validated its own shard of the fonts
+                        n_val_batches = n_val
+                        if opts.multi_gpu:
+                            dist.all_reduce(loss_val_acc)
+                            n_val_batches *= world_size
+                        # only sync with the gpu once, after the whole val loop
+                        for (loss_cat, key), value in zip(loss_val_keys, (loss_val_acc / n_val_batches).tolist()):
+                            loss_val[loss_cat][key] = value
 
-                    if opts.wandb:
-                        for loss_cat in ['img', 'svg']:
-                            # Iterate over keys and values in the loss dictionary
-                            for key, value in loss_val[loss_cat].items():
-                                # Log loss value to WandB
-                                wandb.log({f'VAL/loss_{loss_cat}_{key}': value})
-                        wandb.log({
-                        'VAL_Images/val_trg_img': wandb.Image(ret_dict_val['img']['trg'][0], caption="Val Target"),
-                        'VAL_Images/val_img_output': wandb.Image(ret_dict_val['img']['out'][0], caption="Val Output")
-                        })
+                        if opts.wandb:
+                            wandb.log({
+                            **{f'VAL/loss_{loss_cat}_{key}': value for loss_cat in ['img', 'svg'] for key, value in loss_val[loss_cat].items()},
+                            'VAL_Images/val_trg_img': wandb.Image(ret_dict_val['img']['trg'][0].float(), caption="Val Target"),
+                            'VAL_Images/val_img_output': wandb.Image(ret_dict_val['img']['out'][0].float(), caption="Val Output")
+                            }, step=batches_done)
 
                         
-                    val_msg = (
-                        f"Epoch: {epoch}/{opts.n_epochs}, Batch: {idx}/{len(train_loader)}, "
-                        f"Val loss img l1: {loss_val['img']['l1']: .6f}, "
-                        f"Val loss img pt: {loss_val['img']['vggpt']: .6f}, "
-                        f"Val loss total: {loss_val['svg']['total']: .6f}, "
-                        f"Val loss cmd: {loss_val['svg']['cmd']: .6f}, "
-                        f"Val loss args: {loss_val['svg']['args']: .6f}, "
-                    )
+                        val_msg = (
+                            f"Epoch: {epoch}/{opts.n_epochs}, Batch: {idx}/{n_train}, "
+                            f"Val loss img l1: {loss_val['img']['l1']: .6f}, "
+                            f"Val loss img pt: {loss_val['img']['vggpt']: .6f}, "
+                            f"Val loss total: {loss_val['svg']['total']: .6f}, "
+                            f"Val loss cmd: {loss_val['svg']['cmd']: .6f}, "
+                            f"Val loss args: {loss_val['svg']['args']: .6f}, "
+                        )
 
-                    logfile_val.write(val_msg + "\n")
-                    print(val_msg)
+                        if is_main:
+                            logfile_val.write(val_msg + "\n")
+                            print(val_msg)
         
 
-        scheduler.step()
+            scheduler.step()
 
-        if epoch % opts.freq_ckpt == 0 and epoch >= opts.threshold_ckpt:
-            if opts.multi_gpu:
-                print(f"Saved {dir_ckpt}/{epoch}_{batches_done}.ckpt")
-                torch.save({'model':model_main.module.state_dict(), 'opt':optimizer.state_dict(), 'n_epoch':epoch, 'n_iter':batches_done}, f'{dir_ckpt}/{epoch}_{batches_done}.ckpt')
-            else:
-                print(f"Saved {dir_ckpt}/{epoch}_{batches_done}.ckpt")
-                torch.save({'model':model_main.state_dict(), 'opt':optimizer.state_dict(), 'n_epoch':epoch, 'n_iter':batches_done}, f'{dir_ckpt}/{epoch}_{batches_done}.ckpt')
-            if opts.wandb:
-                artifact = wandb.Artifact('model_main_checkpoints', type='model')
-                artifact.add_file(f'{dir_ckpt}/{epoch}_{batches_done}.ckpt')
-                run.log_artifact(artifact)
-
-    logfile_train.close()
-    logfile_val.close()
+            if epoch % opts.freq_ckpt == 0 and epoch >= opts.threshold_ckpt and is_main:
+                # wait for the previous write, so its errors are raised and serialized checkpoints don't pile up in ram
+                if ckpt_future is not None:
+                    ckpt_future.result()
+                # serialize on this thread so the weights are snapshotted before the next step changes them,
+                # the weights go to safetensors (mmap-able on load), the optimizer state still needs pickle
+                path_ckpt = f'{dir_ckpt}/{epoch}_{batches_done}.ckpt'
+                model_buf = safetensors.torch.save({key: value.contiguous() for key, value in model_base.state_dict().items()})
+                opt_buf = io.BytesIO()
+                torch.save({'opt':optimizer.state_dict(), 'scaler':scaler.state_dict(), 'n_epoch':epoch, 'n_iter':batches_done}, opt_buf)
+                ckpt_future = ckpt_executor.submit(_flush_ckpt, [(model_buf, path_ckpt + '.model.safetensors'), (opt_buf.getbuffer(), path_ckpt + '.opt.pt')],
+                                                   run if opts.wandb else None)
+
+        # surface errors of the last write
+        if ckpt_future is not None:
+            ckpt_future.result()
+    finally:
+        # a pending write is not lost if training raises
+        ckpt_executor.shutdown(wait=True)
+    if is_main:
+        logfile_train.close()
+        logfile_val.close()
+    if opts.multi_gpu:
+        dist.destroy_process_group()
 
 def backup_code(name_exp, exp_path):
     os.makedirs(os.path.join(exp_path,'experiments', name_exp, 'code'), exist_ok=True)